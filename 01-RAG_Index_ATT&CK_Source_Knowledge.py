@@ -1,11 +1,28 @@
 import os
+import sys
 
 # Define a few variables
+verbose = "--verbose" in sys.argv[1:]
 current_directory = os.path.dirname("__file__")
 data_directory = os.path.join(current_directory, "data")
 documents_directory = os.path.join(data_directory, "documents")
 templates_directory = os.path.join(current_directory, "templates")
 group_template = os.path.join(templates_directory, "group.md")
+db_dir = "data/faiss/faiss_index"
+
+# Everything the saved index depends on besides the STIX bundle. Changing any of
+# these invalidates the cached knowledge base.
+build_config = {
+    "embedding_model": "all-MiniLM-L6-v2",
+    "normalize_embeddings": True,
+    "chunk_size": 1000,
+    "chunk_overlap": 200,
+    "separators": ["\n\n", "\n", " ", ""],
+    "index": "IVF-PQ from 39 * 256 vectors, else SQ8",
+    "index_nlist": 256,
+    "index_pq_m": 32,
+    "metric": "inner_product",
+}
 
 
 # Download ATT&CK STIX Data
@@ -17,129 +34,170 @@ stix20_downloader.download_all_domains(release="15.1")
 print(stix20_downloader.downloaded_file_paths)
 
 
-# Initialize ATT&CK Python library
-from attackcti import attack_client
-
-lift = attack_client(local_paths=stix20_downloader.downloaded_file_paths)
-
-# Get a list of the techniques used across all groups
-techniques_used_by_groups = lift.get_techniques_used_by_all_groups()
-print(f"\nTechniques: \n{techniques_used_by_groups[0]}")
-
-
-# Create the ATT&CK groups markdown files
-import copy
-from jinja2 import Template
-
-# Create Group docs
-all_groups = dict()
-for technique in techniques_used_by_groups:
-    if technique["id"] not in all_groups:
-        group = dict()
-        group["group_name"] = technique["name"]
-        group["group_id"] = technique["external_references"][0]["external_id"]
-        group["created"] = technique["created"]
-        group["modified"] = technique["modified"]
-        group["description"] = technique["description"]
-        group["aliases"] = technique["aliases"]
-        if "x_mitre_contributors" in technique:
-            group["contributors"] = technique["x_mitre_contributors"]
-        group["techniques"] = []
-        all_groups[technique["id"]] = group
-    technique_used = dict()
-    technique_used["matrix"] = technique["technique_matrix"]
-    technique_used["domain"] = technique["x_mitre_domains"]
-    technique_used["platform"] = technique["platform"]
-    technique_used["tactics"] = technique["tactic"]
-    technique_used["technique_id"] = technique["technique_id"]
-    technique_used["technique_name"] = technique["technique"]
-    technique_used["use"] = technique["relationship_description"]
-    if "data_sources" in technique:
-        technique_used["data_sources"] = technique["data_sources"]
-    all_groups[technique["id"]]["techniques"].append(technique_used)
-
-if not os.path.exists(documents_directory):
-    print("[+] Creating knowledge directory..")
-    os.makedirs(documents_directory)
-
-print("[+] Creating markadown files for each group..")
-markdown_template = Template(open(group_template).read())
-for key in list(all_groups.keys()):
-    group = all_groups[key]
-    print("  [>>] Creating markdown file for {}..".format(group["group_name"]))
-    group_for_render = copy.deepcopy(group)
-    markdown = markdown_template.render(
-        metadata=group_for_render,
-        group_name=group["group_name"],
-        group_id=group["group_id"],
+# Fingerprint the STIX bundle and build config so warm runs can skip regenerating
+# the knowledge base
+import hashlib
+import json
+import pathlib
+
+build_hash_file = os.path.join(data_directory, ".build_hash")
+build_hash = hashlib.blake2b()
+for stix_path in sorted(stix20_downloader.downloaded_file_paths.values()):
+    with open(stix_path, "rb") as stix_file:
+        for block in iter(lambda: stix_file.read(1 << 20), b""):
+            build_hash.update(block)
+build_hash.update(json.dumps(build_config, sort_keys=True).encode("utf-8"))
+build_hash = build_hash.hexdigest()
+
+build_changed = True
+if os.path.exists(build_hash_file):
+    with open(build_hash_file, encoding="utf-8") as hash_file:
+        build_changed = hash_file.read().strip() != build_hash
+print(f"[+] STIX bundle or build config changed since last build: {build_changed}")
+
+# Reuse the database on disk unless its inputs changed
+reuse_db = os.path.exists(db_dir) and not build_changed
+
+
+if build_changed or not os.path.exists(documents_directory):
+    # Initialize ATT&CK Python library
+    from attackcti import attack_client
+
+    lift = attack_client(local_paths=stix20_downloader.downloaded_file_paths)
+
+    # Get a list of the techniques used across all groups
+    techniques_used_by_groups = lift.get_techniques_used_by_all_groups()
+    print(f"\nTechniques: \n{techniques_used_by_groups[0]}")
+
+    # Create the ATT&CK groups markdown files
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+    # Create Group docs
+    from collections import defaultdict
+
+    all_groups = defaultdict(lambda: {"techniques": []})
+    for technique in techniques_used_by_groups:
+        group = all_groups[technique["id"]]
+        # Every row appends a technique, so an empty list marks the group's first row
+        if not group["techniques"]:
+            group["group_name"] = technique["name"]
+            group["group_id"] = technique["external_references"][0]["external_id"]
+            group["created"] = technique["created"]
+            group["modified"] = technique["modified"]
+            group["description"] = technique["description"]
+            group["aliases"] = technique["aliases"]
+            if "x_mitre_contributors" in technique:
+                group["contributors"] = technique["x_mitre_contributors"]
+        technique_used = dict()
+        technique_used["matrix"] = technique["technique_matrix"]
+        technique_used["domain"] = technique["x_mitre_domains"]
+        technique_used["platform"] = technique["platform"]
+        technique_used["tactics"] = technique["tactic"]
+        technique_used["technique_id"] = technique["technique_id"]
+        technique_used["technique_name"] = technique["technique"]
+        technique_used["use"] = technique["relationship_description"]
+        if "data_sources" in technique:
+            technique_used["data_sources"] = technique["data_sources"]
+        group["techniques"].append(technique_used)
+
+    if not os.path.exists(documents_directory):
+        print("[+] Creating knowledge directory..")
+        os.makedirs(documents_directory)
+
+    print("[+] Creating markadown files for each group..")
+    # Plain-text markdown needs no autoescaping, and caching the compiled template
+    # bytecode skips re-parsing it on later runs
+    jinja_cache_directory = os.path.join(current_directory, ".jinja_cache")
+    os.makedirs(jinja_cache_directory, exist_ok=True)
+    jinja_env = Environment(
+        loader=FileSystemLoader(templates_directory),
+        autoescape=False,
+        auto_reload=False,
+        bytecode_cache=FileSystemBytecodeCache(jinja_cache_directory),
     )
-    file_name = (group["group_name"]).replace(" ", "_")
-    open(f"{documents_directory}/{file_name}.md", encoding="utf-8", mode="w").write(
-        markdown
+    markdown_template = jinja_env.get_template(os.path.basename(group_template))
+    for key in list(all_groups.keys()):
+        group = all_groups[key]
+        print("  [>>] Creating markdown file for {}..".format(group["group_name"]))
+        # The template only reads the group, so render it in place without copying
+        markdown = markdown_template.render(
+            metadata=group,
+            group_name=group["group_name"],
+            group_id=group["group_id"],
+        )
+        file_name = (group["group_name"]).replace(" ", "_")
+        pathlib.Path(f"{documents_directory}/{file_name}.md").write_text(
+            markdown, encoding="utf-8"
+        )
+
+
+# Loading and chunking the markdown is only needed to build a new database
+if not reuse_db:
+    # Load the documents
+    import itertools
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from langchain_community.document_loaders import UnstructuredMarkdownLoader
+
+    # variables
+    with os.scandir(documents_directory) as entries:
+        group_files = [entry.path for entry in entries if entry.name.endswith(".md")]
+
+    def load_markdown(group):
+        if verbose:
+            print(f" [*] Loading {os.path.basename(group)}")
+        loader = UnstructuredMarkdownLoader(group)
+        return loader.load()
+
+    # Loading Markdown files
+    print("[+] Loading Group markdown files..")
+    # Parsing is CPU-bound, so fan out across processes. Workers are forked because
+    # this script has no __main__ guard and spawned workers would re-run it.
+    if "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            md_docs = list(
+                itertools.chain.from_iterable(
+                    executor.map(load_markdown, group_files, chunksize=8)
+                )
+            )
+    else:
+        md_docs = list(itertools.chain.from_iterable(map(load_markdown, group_files)))
+
+    print(f"[+] Number of .md documents processed: {len(md_docs)}")
+
+    # Print a sample page content
+    print(f"\nSample content:\n\n{md_docs[0].page_content}")
+
+    # Recursively split by character
+    # This text splitter is the recommended one for generic text.
+    # It is parameterized by a list of characters. It tries to split on them in
+    # order until the chunks are small enough. The default list is ["\n\n", "\n", " ", ""].
+    # This has the effect of trying to keep all paragraphs (and then sentences, and then words)
+    # together as long as possible, as those would generically seem to be the strongest semantically related pieces of text.
+
+    from attack_rag.tokenization import BatchTokenTextSplitter
+
+    # Chunking Text
+    print("[+] Initializing RecursiveCharacterTextSplitter..")
+    text_splitter = BatchTokenTextSplitter(
+        chunk_size=build_config["chunk_size"],
+        chunk_overlap=build_config["chunk_overlap"],  # token overlap between chunks
+        add_start_index=False,  # nothing reads metadata["start_index"], so skip locating each chunk in its source
+        separators=build_config["separators"],
     )
 
-# Load the documents
-import glob
-from langchain_community.document_loaders import UnstructuredMarkdownLoader
-
-# variables
-group_files = glob.glob(os.path.join(documents_directory, "*.md"))
-
-# Loading Markdown files
-md_docs = []
-print("[+] Loading Group markdown files..")
-for group in group_files:
-    print(f" [*] Loading {os.path.basename(group)}")
-    loader = UnstructuredMarkdownLoader(group)
-    md_docs.extend(loader.load())
-
-print(f"[+] Number of .md documents processed: {len(md_docs)}")
-
-# Print a sample page content
-print(f"\nSample content:\n\n{md_docs[0].page_content}")
-
+    print("[+] Splitting documents in chunks..")
+    chunks = text_splitter.split_documents(md_docs)
 
-# Recursively split by character
-# This text splitter is the recommended one for generic text.
-# It is parameterized by a list of characters. It tries to split on them in
-# order until the chunks are small enough. The default list is ["\n\n", "\n", " ", ""].
-# This has the effect of trying to keep all paragraphs (and then sentences, and then words)
-# together as long as possible, as those would generically seem to be the strongest semantically related pieces of text.
+    print(f"[+] Number of documents: {len(md_docs)}")
+    print(f"[+] Number of chunks: {len(chunks)}")
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+    print(chunks[0])
+    print(chunks[1])
+    print(chunks[2])
 
-import tiktoken
-
-tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
-
-
-def tiktoken_len(text):
-    tokens = tokenizer.encode(
-        text, disallowed_special=()  # To disable this check for all special tokens
-    )
-    return len(tokens)
-
-
-# Chunking Text
-print("[+] Initializing RecursiveCharacterTextSplitter..")
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000,
-    chunk_overlap=200,  # number of tokens overlap between chunks
-    add_start_index=True,  # the character index at which each split Document starts within the initial Document is preserved
-    length_function=tiktoken_len,
-    separators=["\n\n", "\n", " ", ""],
-)
-
-
-print("[+] Splitting documents in chunks..")
-chunks = text_splitter.split_documents(md_docs)
-
-print(f"[+] Number of documents: {len(md_docs)}")
-print(f"[+] Number of chunks: {len(chunks)}")
-
-print(chunks[0])
-print(chunks[1])
-print(chunks[2])
 
 # Embed the documents
 from langchain_huggingface import HuggingFaceEmbeddings
@@ -149,35 +207,113 @@ from langchain_community.vectorstores import FAISS  # , DistanceStrategy
 # from langchain_openai import OpenAIEmbeddings
 
 # If you want to define an open-source embedding function
-embeddings_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+import torch
+
+# Encode in large batches so a single call saturates the BLAS/CUDA kernels
+embeddings_function = HuggingFaceEmbeddings(
+    model_name=build_config["embedding_model"],
+    model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+    encode_kwargs={
+        "batch_size": 256,
+        "normalize_embeddings": build_config["normalize_embeddings"],
+        "convert_to_numpy": True,
+    },
+)
 # Equivalent to SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
 
 
 # Create or load the database from disk
 # https://python.langchain.com/v0.2/docs/integrations/vectorstores/faiss/
 from langchain_community.vectorstores.faiss import DistanceStrategy
-
-db_dir = "data/faiss/faiss_index"
-
-# Check if database directory exists
-if os.path.exists(db_dir):
-    # Load database from disk
-    db = FAISS.load_local(
-        folder_path=db_dir,
-        embeddings=embeddings_function,
-        distance_strategy=DistanceStrategy.COSINE,
-        allow_dangerous_deserialization=True,
+from langchain_community.docstore.in_memory import InMemoryDocstore
+import faiss
+import numpy as np
+import pickle
+
+nprobe = 10  # number of Voronoi cells scanned per query
+
+
+def build_quantized_index(vectors, nlist=256, pq_m=32):
+    """
+    Train an inner-product index on the unit-normalized embeddings, where inner
+    product equals cosine similarity. Corpora large enough to train IVF-PQ well get
+    it (32 B per vector, approximate search over nprobe cells); anything smaller
+    gets a flat 8-bit scalar quantizer (384 B per vector, exhaustive search with
+    near-fp32 recall). For more compression at some recall cost, an
+    "OPQ32,IVF1024,PQ32" factory string can be used on large corpora.
+    """
+    n, dim = vectors.shape
+    # k-means wants ~39 training points per centroid, both for the nlist coarse
+    # cells and for the 256 centroids of every PQ codebook. Below that, or with so
+    # few cells that nprobe scans them all, IVF-PQ loses recall and saves nothing.
+    nlist = min(nlist, n // 39)
+    if n < 39 * 256 or nlist < nprobe:
+        index = faiss.IndexScalarQuantizer(
+            dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+    else:
+        index = faiss.index_factory(
+            dim, f"IVF{nlist},PQ{pq_m}", faiss.METRIC_INNER_PRODUCT
+        )
+    index.train(vectors)
+    return index
+
+
+if reuse_db:
+    # Load database from disk. The index is memory-mapped read-only so vectors are
+    # paged in on demand; only the docstore pickle is deserialized up front.
+    # IO_FLAG_MMAP maps only IVF inverted lists, and flat-code indexes such as SQ8
+    # need IO_FLAG_MMAP_IFC instead (the two cannot be combined for IVF). Older faiss
+    # releases lack IO_FLAG_MMAP_IFC and read flat codes into RAM.
+    index_path = os.path.join(db_dir, "index.faiss")
+    with open(index_path, "rb") as index_file:
+        is_ivf = index_file.read(2) in (b"Iw", b"Iv")  # IVF index fourcc prefixes
+    if is_ivf:
+        mmap_flag = faiss.IO_FLAG_MMAP
+    else:
+        mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    index = faiss.read_index(index_path, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+    with open(os.path.join(db_dir, "index.pkl"), "rb") as docstore_file:
+        docstore, index_to_docstore_id = pickle.load(docstore_file)
+    db = FAISS(
+        embedding_function=embeddings_function,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        normalize_L2=False,
     )
 else:
     # With OpenAI Embeddings
     # db = FAISS.from_documents(chunks, OpenAIEmbeddings())
 
+    # Embed the chunks and train the index on them
+    texts = [chunk.page_content for chunk in chunks]
+    xb = np.asarray(embeddings_function.embed_documents(texts), dtype="float32")
+    index = build_quantized_index(
+        xb, nlist=build_config["index_nlist"], pq_m=build_config["index_pq_m"]
+    )
+
     # Create a new database
-    db = FAISS.from_documents(
-        chunks, embedding=embeddings_function, distance_strategy=DistanceStrategy.COSINE
+    db = FAISS(
+        embedding_function=embeddings_function,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        normalize_L2=False,
+    )
+    db.add_embeddings(
+        zip(texts, xb.tolist()), metadatas=[chunk.metadata for chunk in chunks]
     )
-    # Sabe database to disk
-    db.save_local("data/faiss/faiss_index")
+    # Sabe database to disk (faiss.write_index under the hood)
+    db.save_local(db_dir)
+    pathlib.Path(build_hash_file).write_text(build_hash, encoding="utf-8")
+
+# Scope IVF searches to the closest cells instead of scanning every vector
+ivf_index = faiss.try_extract_index_ivf(db.index)
+if ivf_index is not None:
+    ivf_index.nprobe = min(nprobe, ivf_index.nlist)
 
 
 # **********************************************
@@ -14,9 +14,32 @@ class Agent:
         """
         pass
     
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+import httpx
 import openai
 
+# Shared clients keyed by (api_key, base_url) so every agent round reuses one
+# pooled HTTP/2 connection instead of opening its own
+_CLIENTS: Dict[Tuple[Optional[str], Optional[str]], openai.OpenAI] = {}
+
+
+def get_openai_client(api_key: str = None, base_url: str = None) -> openai.OpenAI:
+    """
+    Return the process-wide OpenAI client for the given credentials.
+    """
+    key = (api_key, base_url)
+    if key not in _CLIENTS:
+        http_client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            timeout=30,
+        )
+        _CLIENTS[key] = openai.OpenAI(
+            api_key=api_key, base_url=base_url, http_client=http_client, max_retries=2
+        )
+    return _CLIENTS[key]
+
+
 # Define the LLM Client
 class OpenAIChatCompletion:
     """
@@ -26,7 +49,7 @@ class OpenAIChatCompletion:
         """
         Initialize with model, API key, and base URL.
         """
-        self.client = openai.OpenAI(api_key=api_key, base_url=base_url)
+        self.client = get_openai_client(api_key=api_key, base_url=base_url)
         self.model = model
 
     def generate(self, messages: List[Dict], **kwargs) -> Dict[str, Any]:
@@ -36,6 +59,16 @@ class OpenAIChatCompletion:
         params = {'messages': messages, 'model': self.model, **kwargs}
         response = self.client.chat.completions.create(**params)
         return response.choices[0].message
+
+    def generate_stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        """
+        Stream the response content as it arrives, so callers can start parsing
+        (e.g. a ReAct action blob) before the completion has finished.
+        """
+        params = {'messages': messages, 'model': self.model, 'stream': True, **kwargs}
+        for chunk in self.client.chat.completions.create(**params):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
     
 # Integrate the LLM client with the AI Agent
 class Agent:
@@ -47,11 +80,14 @@ class Agent:
         self.tools = tools
         self.memory = memory
 
-    def run(self, messages: List[Dict[str, str]]):
+    def run(self, messages: List[Dict[str, str]], stream: bool = False):
         """
-        Generates a response from the LLM client.
+        Generates a response from the LLM client. With stream=True, returns an
+        iterator over the response text as it arrives.
         """
         # Generate response using the LLM client
+        if stream:
+            return self.llm_client.generate_stream(messages)
         response = self.llm_client.generate(messages)
         return response
     
@@ -81,4 +117,10 @@ myAgent = Agent(llm_client=client)
 response = myAgent.run(messages=messages)
 print(response)
 print("\n\nFinal Answer: \n\n")
-print(response.to_dict())
\ No newline at end of file
+print(response.to_dict())
+
+# Stream the same task, printing the answer as it arrives
+print("\n\nStreamed Answer: \n\n")
+for delta in myAgent.run(messages=messages, stream=True):
+    print(delta, end="", flush=True)
+print()
@@ -0,0 +1,52 @@
+import functools
+import os
+import re
+
+import tiktoken
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_text_splitters.character import _split_text_with_regex
+
+# Loading the BPE merges is expensive, so build the encoder once per process
+_ENC = tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+
+# The recursive splitter keeps re-measuring the same overlapping substrings
+@functools.lru_cache(maxsize=100_000)
+def tiktoken_len(text):
+    # encode_ordinary treats special tokens as text and skips the disallowed scan
+    return len(_ENC.encode_ordinary(text))
+
+
+class BatchTokenTextSplitter(RecursiveCharacterTextSplitter):
+    """
+    Measures all candidate splits of a recursion level with a single batched
+    tiktoken call instead of one Python round-trip per split.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(length_function=self._token_len, **kwargs)
+        self._token_lens = {}
+
+    def _token_len(self, text):
+        length = self._token_lens.get(text)
+        return length if length is not None else tiktoken_len(text)
+
+    def _length_function_batch(self, texts):
+        pending = list({text for text in texts if text not in self._token_lens})
+        if pending:
+            tokens = _ENC.encode_ordinary_batch(pending, num_threads=os.cpu_count())
+            self._token_lens.update(zip(pending, map(len, tokens)))
+        return [self._token_lens[text] for text in texts]
+
+    def _split_text(self, text, separators):
+        # Pick the separator the same way the parent does and pre-measure its splits
+        separator = separators[-1]
+        for _s in separators:
+            if _s == "" or re.search(re.escape(_s), text):
+                separator = _s
+                break
+        splits = _split_text_with_regex(
+            text, re.escape(separator), self._keep_separator
+        )
+        self._length_function_batch(splits)
+        return super()._split_text(text, separators)